@@ -0,0 +1,455 @@
+import logging
+import numpy as np
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+
+
+# Layout of one sample in the samples ring
+SAMPLE_FIELDS = [
+    "inside0",
+    "inside1",
+    "inside2",
+    "inside3",
+    "compressor",
+    "condenser",
+]
+MLX_PRESENCE_BIT = len(SAMPLE_FIELDS)
+# DS18B20 readings follow the fields above, in the order of the ROM table the
+# child writes at startup. ROMs are stored as integers, 0 for an empty slot.
+PROBES_OFFSET = len(SAMPLE_FIELDS)
+MAX_PROBES = 8
+SAMPLE_WIDTH = PROBES_OFFSET + MAX_PROBES
+FRAME_SIZE = 768
+
+RING_SLOTS = 8
+MAX_READ_RETRY = 10
+
+SAMPLE_PERIOD_SEC = 2
+# Child is considered hung when it didn't produce a sample for this long
+HANG_TIMEOUT_SEC = 30
+# Shorter than the main process watchdog so a slow startup is reported
+STARTUP_TIMEOUT_SEC = 45
+SUPERVISOR_PERIOD_SEC = 1
+MAX_RESTART_BACKOFF_SEC = 30
+# Proxies refuse to serve data older than this. While the child is down or
+# restarting the control loop gets AcquisitionUnavailable and must not act.
+STALE_DATA_SEC = 5 * SAMPLE_PERIOD_SEC
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+class SharedRing:
+    """Fixed width ring of 8 byte records (float64 by default) in shared
+    memory.
+
+    Single writer, any number of readers. Every slot carries a seqlock
+    counter: odd while the writer is in the middle of an update, bumped to
+    the next even value once done. Readers copy the latest slot straight out
+    of the shared block and retry if the counter moved during the copy, so
+    nothing is pickled or piped between processes.
+
+    Header: [number of records written, presence bitmask]
+    """
+
+    HEADER_SIZE = 2 * 8
+
+    def __init__(self, width, slots=RING_SLOTS, name=None, dtype=np.float64):
+        self.width = width
+        self.slots = slots
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=SharedRing.HEADER_SIZE + slots * (2 + width) * 8
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Python < 3.13 tracks attached segments too and would unlink
+            # them when the attaching process exits.
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        buf = self.shm.buf
+        offset = 0
+        self.header = np.ndarray((2,), np.uint64, buf, offset)
+        offset += SharedRing.HEADER_SIZE
+        self.seq = np.ndarray((slots,), np.uint64, buf, offset)
+        offset += slots * 8
+        self.timestamps = np.ndarray((slots,), np.float64, buf, offset)
+        offset += slots * 8
+        self.data = np.ndarray((slots, width), dtype, buf, offset)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        return int(self.header[0])
+
+    @property
+    def presence(self):
+        return int(self.header[1])
+
+    @presence.setter
+    def presence(self, mask):
+        self.header[1] = mask
+
+    def write(self, values, timestamp=None):
+        count = self.count
+        slot = count % self.slots
+
+        self.seq[slot] += 1
+        self.data[slot] = values
+        self.timestamps[slot] = timestamp if timestamp is not None else time.time()
+        self.seq[slot] += 1
+
+        self.header[0] = count + 1
+
+    def latest(self):
+        for _ in range(MAX_READ_RETRY):
+            count = self.count
+            if count == 0:
+                return None, None
+
+            slot = (count - 1) % self.slots
+            seq = self.seq[slot]
+            if seq % 2:
+                continue
+
+            timestamp = float(self.timestamps[slot])
+            values = self.data[slot].copy()
+            if self.seq[slot] == seq:
+                return timestamp, values
+
+        raise RuntimeError("Could not get a consistent read from shared ring")
+
+    def close(self, unlink=False):
+        # Views must be released before the block can be closed
+        del self.header, self.seq, self.timestamps, self.data
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class AcquisitionUnavailable(RuntimeError):
+    """The child has no fresh data, it is most likely being restarted."""
+
+
+def _check_fresh(timestamp):
+    if timestamp is None:
+        raise AcquisitionUnavailable("No data from acquisition process yet")
+
+    age = time.time() - timestamp
+    if age > STALE_DATA_SEC:
+        raise AcquisitionUnavailable(f"Acquisition data is {round(age)}s old")
+
+
+class SharedTemperatureSensor:
+    """Stands in for a TMP117 in the control process."""
+
+    def __init__(self, ring, index, name):
+        self.ring = ring
+        self.index = index
+        self.name = name
+
+    def _index(self):
+        return self.index
+
+    @property
+    def temperature(self):
+        index = self._index()
+        timestamp, values = self.ring.latest()
+        _check_fresh(timestamp)
+
+        temperature = values[index]
+        if np.isnan(temperature):
+            raise RuntimeError(f"Acquisition process could not read {self.name}")
+
+        return float(temperature)
+
+
+class SharedProbe(SharedTemperatureSensor):
+    """Stands in for a `onewire_probes.DS18B20Probe` in the control process.
+
+    The slot is looked up by ROM on every read since a restarted child may
+    find the probes in a different order.
+    """
+
+    def __init__(self, ring, roms, rom):
+        super().__init__(ring, None, f"DS18B20 {rom}")
+        self.roms = roms
+        self.rom = rom
+
+    def _index(self):
+        _, roms = self.roms.latest()
+        rom = np.uint64(int(self.rom, 16))
+        slots = np.flatnonzero(roms == rom) if roms is not None else []
+        if not len(slots):
+            raise RuntimeError(f"Acquisition process doesn't see {self.name}")
+
+        return PROBES_OFFSET + int(slots[0])
+
+
+class SharedOneWireProbes:
+    """Stands in for `onewire_probes.OneWireProbes` in the control process,
+    conversions are driven by the acquisition process."""
+
+    def __init__(self, ring, roms, rom_list):
+        self.probes = {rom: SharedProbe(ring, roms, rom) for rom in rom_list}
+
+    @property
+    def primary(self):
+        return next(iter(self.probes.values()))
+
+    def tick(self):
+        pass
+
+
+class SharedIRCamera:
+    """Stands in for the MLX90640 in the control process."""
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def getFrame(self, framebuf):
+        timestamp, frame = self.ring.latest()
+        _check_fresh(timestamp)
+
+        framebuf[:] = frame
+
+
+class Acquisition:
+    """Runs the hardware acquisition in a child process and restarts it if it
+    crashes or stops producing samples."""
+
+    def __init__(self, vid, pid, compressor_tmp117_addr, condenser_tmp117_addr):
+        self.args = [vid, pid, compressor_tmp117_addr, condenser_tmp117_addr]
+
+        self.samples = SharedRing(SAMPLE_WIDTH)
+        self.frames = SharedRing(FRAME_SIZE)
+        self.roms = SharedRing(MAX_PROBES, slots=1, dtype=np.uint64)
+
+        self.process = None
+        self.process_start_timestamp = None
+        self.restart_count = 0
+
+        self._stopping = False
+        self._supervisor = None
+
+    def start(self):
+        self._spawn()
+        self._supervisor = threading.Thread(
+            target=self._supervise, name="acquisition-supervisor", daemon=True
+        )
+        self._supervisor.start()
+
+    def stop(self):
+        self._stopping = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+        self.samples.close(unlink=True)
+        self.frames.close(unlink=True)
+        self.roms.close(unlink=True)
+
+    def wait_ready(self, timeout=STARTUP_TIMEOUT_SEC):
+        deadline = time.monotonic() + timeout
+        while self.samples.count == 0:
+            returncode = self.process.poll()
+            if returncode is not None:
+                raise RuntimeError(
+                    f"Acquisition process exited during startup ({returncode})"
+                )
+            if time.monotonic() > deadline:
+                raise RuntimeError("Acquisition process did not produce samples")
+            time.sleep(0.1)
+
+    def sensors(self):
+        """Same shape as `i2c_helper.enumerate` so `Fridge` can't tell the
+        difference."""
+        self.wait_ready()
+
+        present = [
+            bool(self.samples.presence & (1 << i)) for i in range(len(SAMPLE_FIELDS))
+        ]
+        proxies = [
+            SharedTemperatureSensor(self.samples, i, SAMPLE_FIELDS[i])
+            if present[i]
+            else None
+            for i in range(len(SAMPLE_FIELDS))
+        ]
+        mlx = (
+            SharedIRCamera(self.frames)
+            if self.samples.presence & (1 << MLX_PRESENCE_BIT)
+            else None
+        )
+
+        # Written by the child before its first sample
+        _, roms = self.roms.latest()
+        rom_list = [f"{int(rom):016x}" for rom in roms if rom]
+        onewire_probes = (
+            SharedOneWireProbes(self.samples, self.roms, rom_list) if rom_list else None
+        )
+
+        return mlx, proxies[4], proxies[5], proxies[0:4], onewire_probes
+
+    def _spawn(self):
+        logger.info("🚀 Starting acquisition process")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)]
+            + [self.samples.name, self.frames.name, self.roms.name]
+            + [str(arg) for arg in self.args]
+        )
+        self.process_start_timestamp = time.monotonic()
+
+    def _restart(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+        self.restart_count += 1
+        backoff = min(2 ** self.restart_count, MAX_RESTART_BACKOFF_SEC)
+        logger.info(f"⏳ Restarting acquisition process in {backoff}s")
+        time.sleep(backoff)
+
+        self._spawn()
+
+    def _supervise(self):
+        last_count = self.samples.count
+        last_progress = time.monotonic()
+
+        while not self._stopping:
+            time.sleep(SUPERVISOR_PERIOD_SEC)
+            if self._stopping:
+                break
+
+            count = self.samples.count
+            if count != last_count:
+                last_count = count
+                last_progress = time.monotonic()
+                if (
+                    self.restart_count
+                    and (time.monotonic() - self.process_start_timestamp)
+                    > MAX_RESTART_BACKOFF_SEC
+                ):
+                    self.restart_count = 0
+
+            if last_progress > self.process_start_timestamp:
+                hang_timeout = HANG_TIMEOUT_SEC
+            else:
+                hang_timeout = STARTUP_TIMEOUT_SEC
+
+            returncode = self.process.poll()
+            if returncode is not None:
+                logger.error(f"💥 Acquisition process exited ({returncode})")
+            elif (time.monotonic() - last_progress) > hang_timeout:
+                logger.error("💥 Acquisition process is hung")
+            else:
+                continue
+
+            self._restart()
+            last_progress = time.monotonic()
+
+
+def _read(func, error_message):
+    try:
+        return func()
+    except Exception:
+        logger.exception(error_message)
+        return np.nan
+
+
+def acquire(
+    samples_name,
+    frames_name,
+    roms_name,
+    vid,
+    pid,
+    compressor_tmp117_addr,
+    condenser_tmp117_addr,
+):
+    import i2c_helper
+    import onewire_probes as onewire
+
+    samples = SharedRing(SAMPLE_WIDTH, name=samples_name)
+    frames = SharedRing(FRAME_SIZE, name=frames_name)
+    roms = SharedRing(MAX_PROBES, slots=1, name=roms_name, dtype=np.uint64)
+
+    buses = i2c_helper.open_buses(vid, pid)
+    (
+        mlx,
+        compressor_tmp117,
+        condenser_tmp117,
+        inside_tmp117,
+        onewire_probes,
+    ) = i2c_helper.enumerate(
+        buses, compressor_tmp117_addr, condenser_tmp117_addr, onewire.load_config()
+    )
+    sensors = list(inside_tmp117) + [compressor_tmp117, condenser_tmp117]
+
+    probes = list(onewire_probes.probes.values()) if onewire_probes else []
+    if len(probes) > MAX_PROBES:
+        logger.warning(
+            f"Only the first {MAX_PROBES} of {len(probes)} DS18B20 are shared with"
+            " the control process"
+        )
+        probes = probes[:MAX_PROBES]
+    rom_table = np.zeros(MAX_PROBES, np.uint64)
+    for i, probe in enumerate(probes):
+        rom_table[i] = int(probe.rom, 16)
+    roms.write(rom_table)
+
+    presence = 0
+    for i, sensor in enumerate(sensors):
+        if sensor:
+            presence |= 1 << i
+    if mlx:
+        presence |= 1 << MLX_PRESENCE_BIT
+    samples.presence = presence
+
+    values = np.full(SAMPLE_WIDTH, np.nan)
+    frame_buffer = [0] * FRAME_SIZE
+    while True:
+        start = time.monotonic()
+
+        if onewire_probes:
+            onewire_probes.tick()
+
+        for i, sensor in enumerate(sensors):
+            if sensor:
+                values[i] = _read(
+                    lambda: sensor.temperature, f"Error reading {SAMPLE_FIELDS[i]}"
+                )
+        for i, probe in enumerate(probes):
+            values[PROBES_OFFSET + i] = _read(
+                lambda: probe.temperature, f"Error reading DS18B20 {probe.rom}"
+            )
+        samples.write(values)
+
+        if mlx:
+            try:
+                mlx.getFrame(frame_buffer)
+                frames.write(frame_buffer)
+            except Exception:
+                logger.exception("Could not read mlx frame")
+
+        time.sleep(max(0, SAMPLE_PERIOD_SEC - (time.monotonic() - start)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s] %(levelname)-8s [acquisition] %(message)s",
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    samples_name, frames_name, roms_name = sys.argv[1:4]
+    acquire(samples_name, frames_name, roms_name, *[int(arg) for arg in sys.argv[4:8]])
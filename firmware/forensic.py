@@ -1,4 +1,4 @@
-import code, traceback, signal
+import code, os, traceback, signal, time
 
 
 teardown = None
@@ -28,3 +28,35 @@ def teardown_function(function):
 
 def register_debug_hook():
     signal.signal(signal.SIGUSR1, debug)  # Register handler
+
+
+def register_profile_hook(profiler):
+    def toggle_profiler(sig, frame):
+        if profiler.is_running:
+            profiler.stop()
+        else:
+            profiler.start("signal")
+
+    signal.signal(signal.SIGPROF, toggle_profiler)
+
+
+def register_trace_dump_hook(tracer):
+    def dump_trace(sig, frame):
+        tracer.dump("signal", force=True)
+
+    signal.signal(signal.SIGHUP, dump_trace)
+
+
+def timestamped_path(directory, reason, extension):
+    """Diagnostic file name sorting by creation time, see `prune()`."""
+    return os.path.join(
+        directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{reason}{extension}"
+    )
+
+
+def prune(directory, extension, max_files):
+    """Only keep the `max_files` most recent files written by
+    `timestamped_path()`."""
+    names = sorted(f for f in os.listdir(directory) if f.endswith(extension))
+    for name in names[:-max_files]:
+        os.remove(os.path.join(directory, name))
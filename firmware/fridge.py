@@ -1,18 +1,106 @@
 import asyncio
 import io
 import logging
+import math
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import time
+import tracing
 
-from datetime import timedelta
+from acquisition import AcquisitionUnavailable
+from fusion import TemperatureEstimator
+from power import PowerMeter
 
 
 logger = logging.getLogger(__name__)
 if "DEBUG" in os.environ:
     logger.setLevel(logging.DEBUG)
 
+# Raw (truncated) payload rather than ON/OFF, unexpected payloads are what an
+# incident trace needs
+RELAY_STATE_RECEIVED = tracing.event(
+    "relay_state_received", "16sB", "📝 Received relay state '{}' with QoS {}"
+)
+RELAY_STATE_EXPECTED = tracing.event(
+    "relay_state_expected", "", "✔️ Expected relay state change"
+)
+RELAY_STATE_SET = tracing.event("relay_state_set", "", "✔️ Requested state is set")
+RELAY_STATE_WAIT = tracing.event(
+    "relay_state_wait", "B", "⏳ Relay is not yet at state (retry {})"
+)
+RELAY_ALREADY_AT_STATE = tracing.event(
+    "relay_already_at_state", "?", "🤔 Relay is already at ON={}"
+)
+RELAY_STATE_FINE = tracing.event(
+    "relay_state_fine",
+    "",
+    "We we're asked to reset the relay state but it's already fine",
+)
+RELAY_KEEPALIVE = tracing.event("relay_keepalive", "", "⚡ Relay keepalive")
+
+THERMOSTAT_RUN = tracing.event(
+    "thermostat_run",
+    "?fffffff",
+    "🤖 Thermostat ON={} t({} < {} < {}) wp({} < {}) s1(0 < {}) beer avg(-1.5 < {})",
+)
+DEFROST_THERMOSTAT_RUN = tracing.event(
+    "defrost_thermostat_run", "?fff", "🤖 Thermostat ON={} t({} < {} < {})"
+)
+BEER_THERMOSTAT_RUN = tracing.event(
+    "beer_thermostat_run",
+    "?ffffff",
+    "🤖 Thermostat ON={} beer({} < {:.2f}±{:.2f} < {}) t({} < {})",
+)
+
+IR_FRAME_READ = tracing.event("ir_frame_read", "", "Getting frame")
+IR_FRAME_RENDER = tracing.event("ir_frame_render", "", "Converting frame to image")
+TMP117_TEMPERATURE = tracing.event(
+    "tmp117_temperature", "Bf", "│   └── Temperature{}: {:.2f}°C"
+)
+COMPRESSOR_TEMPERATURE = tracing.event(
+    "compressor_temperature", "f", "├── Temperature (compressor): {:.2f}°C"
+)
+CONDENSER_TEMPERATURE = tracing.event(
+    "condenser_temperature", "f", "├── Temperature (condenser): {:.2f}°C"
+)
+EVAPORATOR_TEMPERATURE = tracing.event(
+    "evaporator_temperature", "f", "├── Temperature (evaporator): {:.2f}°C"
+)
+WATERPROOF_TEMPERATURE = tracing.event(
+    "waterproof_temperature", "f", "├── Temperature (waterproof): {:.2f}°C"
+)
+SHELF1_TEMPERATURE = tracing.event(
+    "shelf1_temperature", "f", "├── Temperature (shelf1): {:.2f}°C"
+)
+BEER_ROI = tracing.event(
+    "beer_roi", "fff", "🍺 min:{:.2f}, max:{:.2f}, avg:{:.2f}"
+)
+POWER = tracing.event("power", "f", "├── Power: {}W")
+ESTIMATE = tracing.event(
+    "estimate",
+    "fffff",
+    "├── Estimate: beer {:.2f}±{:.2f}°C ({:.2f}°C/h), air {:.2f}°C ({:.2f}°C/h)",
+)
+
+FRIDGE_ALREADY_AT_STATE = tracing.event(
+    "fridge_already_at_state", "?", "🤔 Fridge is already ON={}"
+)
+FRIDGE_IN_COOLDOWN = tracing.event("fridge_in_cooldown", "", "⏱️ We are in cooldown")
+COMPRESSOR_TOO_HOT = tracing.event(
+    "compressor_too_hot", "", "🌡️ Compressor is too hot to restart"
+)
+COMPRESSOR_MIN_TIME = tracing.event(
+    "compressor_min_time", "?f", "🕐 Compressor only ON={} for {:.0f}s"
+)
+RELAY_COMMAND = tracing.event("relay_command", "?", "Relay ON={}")
+COMPRESSOR_ALLOWED_DELTA = tracing.event(
+    "compressor_allowed_delta", "f", "💡 Allowed compressor ΔT: {:.2f}°C"
+)
+IN_COOLDOWN_SINCE = tracing.event(
+    "in_cooldown_since", "f", "🕐 In cooldown since {:.0f}s"
+)
+
 
 class S31Relay:
     def __init__(self, mqtt_client):
@@ -25,11 +113,24 @@ class S31Relay:
 
         self.last_keepalive_timestamp = None
 
+        # Must exist before subscribing, the retained state comes right away
+        # on the MQTT thread.
+        self.power_meter = PowerMeter()
+
         self.mqtt_client.message_callback_add(
             "fridge-relay/switch/sonoff_s31_relay/state", self._state_change_callback
         )
         self.mqtt_client.subscribe("fridge-relay/switch/sonoff_s31_relay/state")
 
+        for sensor, callback in (
+            ("power", self._power_callback),
+            ("current", self._current_callback),
+            ("voltage", self._voltage_callback),
+        ):
+            topic = f"fridge-relay/sensor/sonoff_s31_{sensor}/state"
+            self.mqtt_client.message_callback_add(topic, callback)
+            self.mqtt_client.subscribe(topic)
+
     @property
     def state_matches_requested(self):
         return self.state == self.state_requested
@@ -47,18 +148,48 @@ class S31Relay:
         return time.time() - self.last_keepalive_timestamp
 
     def _state_change_callback(self, client, userdata, message):
-        logger.debug(
-            f"📝 Received message {message.payload} on topic {message.topic} with QoS {message.qos}"
-        )
+        RELAY_STATE_RECEIVED(message.payload, message.qos)
 
         self.state = message.payload.decode("utf-8")
         self.state_change_timestamp = time.time()
+        self.power_meter.compressor_state_changed(
+            self.is_on, self.state_change_timestamp
+        )
 
         if self.state_matches_requested:
-            logger.debug("✔️ Expected relay state change")
+            RELAY_STATE_EXPECTED()
         else:
             logger.error("❌ Unrequested relay state change")
 
+    def _parse_sample(self, message):
+        try:
+            sample = float(message.payload)
+        except ValueError:
+            logger.error(f"❌ Invalid sample {message.payload} on {message.topic}")
+            return None
+
+        # ESPHome publishes nan while the CSE7766 has no reading
+        if not math.isfinite(sample):
+            logger.debug(f"🤔 Ignoring sample {message.payload} on {message.topic}")
+            return None
+
+        return sample
+
+    def _power_callback(self, client, userdata, message):
+        power = self._parse_sample(message)
+        if power is not None:
+            self.power_meter.add_power_sample(power)
+
+    def _current_callback(self, client, userdata, message):
+        current = self._parse_sample(message)
+        if current is not None:
+            self.power_meter.add_current_sample(current)
+
+    def _voltage_callback(self, client, userdata, message):
+        voltage = self._parse_sample(message)
+        if voltage is not None:
+            self.power_meter.add_voltage_sample(voltage)
+
     def turn_on(self):
         self.set_state("ON")
 
@@ -76,30 +207,28 @@ class S31Relay:
             retry = 0
             while True:
                 if self.state == self.state_requested:
-                    logger.debug("✔️ Requested state is set")
+                    RELAY_STATE_SET()
                     break
 
                 if retry >= 10:
                     logger.error("❌ Relay did not change state")
                     raise RuntimeError("Relay did not change state")
 
-                logger.debug("⏳ Relay is not yet at state")
+                RELAY_STATE_WAIT(retry)
                 retry += 1
                 time.sleep(1)
         else:
-            logger.debug(f"🤔 Relay is already at {state} ({self.state})")
+            RELAY_ALREADY_AT_STATE(state == "ON")
 
     def set_to_expected_state(self):
         if not self.state_matches_requested:
             logger.info("Resetting relay to expected state")
             self.set_state(self.state_requested)
         else:
-            logger.debug(
-                "We we're asked to reset the relay state but it's already fine"
-            )
+            RELAY_STATE_FINE()
 
     def keepalive(self):
-        logger.debug("⚡ Relay keepalive")
+        RELAY_KEEPALIVE()
         self.mqtt_client.publish("fridge-relay/keepalive", True)
         self.last_keepalive_timestamp = time.time()
 
@@ -119,26 +248,30 @@ class Thermostat:
         else:
             self.fridge.off()
 
-    def run(self):
+    def run(self, temperature, shelf1_temperature):
         if not self.fridge:
             return
 
-        temperature = self.fridge.evaporator_temperature
         waterproof_temperature = self.fridge.waterproof_temperature
-        shelf1_temperature = self.fridge.shelf1_temperature
-
-        logger.debug(f"🤖 Thermostat {'❄️' if self.fridge.is_on else '🚫'}")
-        logger.debug(f"   └──  t({self.min_t} < {temperature} < {self.max_t})")
-        logger.debug(f"   └── wp({self.min_wp_t} < {waterproof_temperature})")
-        logger.debug(f"   └── s1({0} < {shelf1_temperature})")
-        logger.debug(f"   └── beer avg({-1.5} < {self.fridge.coldest_beer_temperature})")
+        coldest_beer_temperature = self.fridge.coldest_beer_temperature
+
+        THERMOSTAT_RUN(
+            self.fridge.is_on,
+            self.min_t,
+            temperature,
+            self.max_t,
+            self.min_wp_t,
+            waterproof_temperature,
+            shelf1_temperature,
+            coldest_beer_temperature,
+        )
 
         if self.fridge.is_on:
             if (
                 temperature < self.min_t
                 or waterproof_temperature < self.min_wp_t
                 or shelf1_temperature < 0
-                or self.fridge.coldest_beer_temperature < -1.5
+                or coldest_beer_temperature < -1.5
             ):
                 self.fridge.off()
         elif not self.fridge.is_on:
@@ -160,14 +293,11 @@ class DefrostThermostat:
         else:
             self.fridge.off()
 
-    def run(self):
+    def run(self, temperature, shelf1_temperature):
         if not self.fridge:
             return
 
-        temperature = self.fridge.evaporator_temperature
-
-        logger.debug(f"🤖 Thermostat {'❄️' if self.fridge.is_on else '🚫'}")
-        logger.debug(f"   └──  t({self.min_t} < {temperature} < {self.max_t})")
+        DEFROST_THERMOSTAT_RUN(self.fridge.is_on, self.min_t, temperature, self.max_t)
 
         if self.fridge.is_on:
             if temperature < self.min_t:
@@ -177,6 +307,60 @@ class DefrostThermostat:
                 self.fridge.on()
 
 
+class BeerThermostat:
+    """Regulates on the fused beer temperature estimate instead of raw
+    thresholds. The estimate is projected `lookahead_sec` ahead using the
+    estimated rate so the compressor stops before the beer overshoots, and
+    the lower uncertainty bound is used so we err on the side of not
+    freezing."""
+
+    def __init__(self, min_t=-2, max_t=1, min_evaporator_t=-20, lookahead_sec=15 * 60):
+        self.fridge = None
+        self.min_t = min_t
+        self.max_t = max_t
+        self.min_evaporator_t = min_evaporator_t
+        self.lookahead_sec = lookahead_sec
+
+    def set_fridge(self, fridge):
+        self.fridge = fridge
+
+        if self.fridge.evaporator_temperature > self.max_t:
+            self.fridge.on()
+        else:
+            self.fridge.off()
+
+    def run(self, evaporator_temperature, shelf1_temperature):
+        if not self.fridge:
+            return
+
+        beer_temperature, beer_std = self.fridge.estimator.beer_temperature
+        if beer_temperature is None:
+            return
+
+        beer_rate, _ = self.fridge.estimator.beer_rate
+        predicted = beer_temperature + beer_rate * self.lookahead_sec / 3600
+
+        BEER_THERMOSTAT_RUN(
+            self.fridge.is_on,
+            self.min_t,
+            predicted,
+            2 * beer_std,
+            self.max_t,
+            self.min_evaporator_t,
+            evaporator_temperature,
+        )
+
+        if self.fridge.is_on:
+            if (
+                predicted - 2 * beer_std < self.min_t
+                or evaporator_temperature < self.min_evaporator_t
+            ):
+                self.fridge.off()
+        elif not self.fridge.is_on:
+            if predicted > self.max_t:
+                self.fridge.on()
+
+
 class Fridge:
     COOLDOWN_TIME_SECONDS = 10 * 60
     MIN_ON_SECONDS = 5 * 60
@@ -203,8 +387,15 @@ class Fridge:
         self.relay = relay
         self.thermostat = thermostat
 
+        self.estimator = TemperatureEstimator()
+
         self.in_cooldown = False
         if self.thermostat:
+            if self.relay:
+                self.relay.power_meter.mode = (
+                    f"{type(self.thermostat).__name__}"
+                    f"({self.thermostat.min_t}, {self.thermostat.max_t})"
+                )
             self.thermostat.set_fridge(self)
 
         self.waterproof_temperature_cache = None
@@ -223,7 +414,7 @@ class Fridge:
         else:
             frame_query_buffer = [0] * 768
 
-            logger.debug("Getting frame")
+            IR_FRAME_READ()
             self._retry(
                 lambda: self.ir_camera.getFrame(frame_query_buffer),
                 "Could not read mlx frame",
@@ -247,7 +438,6 @@ class Fridge:
     def discrete_temperature_readings(self):
         readings = []
 
-        logger.debug(f"├── TMP117")
         for i, sensor in enumerate(self.discrete_temperature_sensors):
             if not sensor:
                 break
@@ -255,7 +445,7 @@ class Fridge:
             temp = self._retry(
                 lambda: sensor.temperature, f"Error reading TMP117 ({i})"
             )
-            logger.debug(f"│   └── Temperature{i}: {temp}°C")
+            TMP117_TEMPERATURE(i, temp)
             readings.append(round(temp, 2))
 
         return readings
@@ -266,7 +456,7 @@ class Fridge:
             lambda: self.compressor_sensor.temperature,
             f"Error reading compressor TMP117",
         )
-        logger.debug(f"├── Temperature (compressor): {temp}°C")
+        COMPRESSOR_TEMPERATURE(temp)
 
         return round(temp, 2)
 
@@ -275,7 +465,7 @@ class Fridge:
         temp = self._retry(
             lambda: self.condenser_sensor.temperature, f"Error reading condenser TMP117"
         )
-        logger.debug(f"├── Temperature (condenser): {temp}°C")
+        CONDENSER_TEMPERATURE(temp)
 
         return round(temp, 2)
 
@@ -285,7 +475,7 @@ class Fridge:
             lambda: self.discrete_temperature_sensors[1].temperature,
             f"Error reading condenser TMP117",
         )
-        logger.debug(f"├── Temperature (evaporator): {temp}°C")
+        EVAPORATOR_TEMPERATURE(temp)
 
         return round(temp, 2)
 
@@ -304,7 +494,7 @@ class Fridge:
             self.waterproof_temperature_cache = temp
             self.waterproof_temperature_cache_timestamp = time.time()
 
-        logger.debug(f"├── Temperature (waterproof): {temp}°C")
+        WATERPROOF_TEMPERATURE(temp)
 
         return round(temp, 2)
 
@@ -314,7 +504,7 @@ class Fridge:
             lambda: self.discrete_temperature_sensors[0].temperature,
             f"Error reading condenser TMP117",
         )
-        logger.debug(f"├── Temperature (shelf1): {temp}°C")
+        SHELF1_TEMPERATURE(temp)
 
         return round(temp, 2)
 
@@ -323,15 +513,11 @@ class Fridge:
         coldest_beers_temp = self.ir_frame[10:18, 2:8]
         # np.set_printoptions(precision=1, linewidth=np.inf)
         # logger.debug(f"\n{coldest_beers_temp.round(1)}")
-        logger.debug(
-            "🍺 min:{}, max:{}, avg:{}".format(
-                round(np.min(coldest_beers_temp), 2),
-                round(np.max(coldest_beers_temp), 2),
-                round(np.average(coldest_beers_temp), 2),
-            )
-        )
+        average = np.average(coldest_beers_temp)
+        if BEER_ROI.enabled:
+            BEER_ROI(np.min(coldest_beers_temp), np.max(coldest_beers_temp), average)
 
-        return round(np.average(coldest_beers_temp), 2)
+        return round(average, 2)
 
     @property
     def ir_self1_temperature(self):
@@ -339,9 +525,40 @@ class Fridge:
 
         return round(temp, 2)
 
+    @property
+    def beer_temperature(self):
+        temp, _ = self.estimator.beer_temperature
+        return round(temp, 2) if temp is not None else None
+
+    @property
+    def beer_temperature_uncertainty(self):
+        _, std = self.estimator.beer_temperature
+        return round(std, 2) if std is not None else None
+
+    @property
+    def beer_temperature_rate(self):
+        rate, _ = self.estimator.beer_rate
+        return round(rate, 2) if rate is not None else None
+
+    @property
+    def air_temperature(self):
+        temp, _ = self.estimator.air_temperature
+        return round(temp, 2) if temp is not None else None
+
+    @property
+    def air_temperature_rate(self):
+        rate, _ = self.estimator.air_rate
+        return round(rate, 2) if rate is not None else None
+
     @property
     def power_usage(self):
-        raise NotImplementedError()
+        if not self.relay:
+            return None
+
+        power = self.relay.power_meter.power
+        POWER(power if power is not None else float("nan"))
+
+        return power
 
     @property
     def is_on(self):
@@ -360,6 +577,9 @@ class Fridge:
             try:
                 ret = func()
                 break
+            except AcquisitionUnavailable:
+                # Retrying won't help, the acquisition process is restarting
+                raise
             except Exception as e:
                 logger.exception(error_message)
                 if retry == (MAX_RETRY - 1):
@@ -369,7 +589,7 @@ class Fridge:
         return ret
 
     def ir_frame_to_image(self, frame):
-        logger.debug("Converting frame to image")
+        IR_FRAME_RENDER()
         im = plt.imshow(frame)
         plt.colorbar(im)
         image = io.BytesIO()
@@ -383,24 +603,22 @@ class Fridge:
             return
 
         if self.is_on:
-            logger.debug(f"🤔 Fridge is already ON")
+            FRIDGE_ALREADY_AT_STATE(True)
             return
 
         if self.in_cooldown:
-            logger.debug("⏱️ We are in cooldown")
+            FRIDGE_IN_COOLDOWN()
             return
 
         if self.compressor_temperature >= Fridge.MAX_COMPRESSOR_START_TEMP_C:
-            logger.debug("🌡️ Compressor is too hot to restart")
+            COMPRESSOR_TOO_HOT()
             return
 
         if self.relay.seconds_since_last_state_change < Fridge.MIN_OFF_SECONDS:
-            logger.debug(
-                f"🕐 Compressor only OFF for {timedelta(seconds=int(self.relay.seconds_since_last_state_change))}"
-            )
+            COMPRESSOR_MIN_TIME(False, self.relay.seconds_since_last_state_change)
             return
 
-        logger.debug("Relay ON")
+        RELAY_COMMAND(True)
         self.relay.turn_on()
 
     def off(self, emergency=False):
@@ -408,34 +626,55 @@ class Fridge:
             return
 
         if not self.is_on:
-            logger.debug(f"🤔 Fridge is already OFF")
+            FRIDGE_ALREADY_AT_STATE(False)
             return
 
         if not emergency:
             if self.relay.seconds_since_last_state_change < Fridge.MIN_ON_SECONDS:
-                logger.debug(
-                    f"🕐 Compressor only ON for {timedelta(seconds=int(self.relay.seconds_since_last_state_change))}"
+                COMPRESSOR_MIN_TIME(
+                    True, self.relay.seconds_since_last_state_change
                 )
                 return
 
-        logger.debug("Relay OFF")
+        RELAY_COMMAND(False)
         self.relay.turn_off()
 
+    def update_estimate(self, evaporator_temperature, shelf1_temperature):
+        self.estimator.update(
+            evaporator_temperature,
+            shelf1_temperature,
+            self.waterproof_temperature if self.waterproof_sensor else None,
+            self.coldest_beer_temperature,
+        )
+        if ESTIMATE.enabled:
+            ESTIMATE(
+                *self.estimator.beer_temperature,
+                self.estimator.beer_rate[0],
+                self.estimator.air_temperature[0],
+                self.estimator.air_rate[0],
+            )
+
     def run(self):
+        # Read once, everything below works on the same readings
+        evaporator_temperature = self.evaporator_temperature
+        shelf1_temperature = self.shelf1_temperature
+
+        self.update_estimate(evaporator_temperature, shelf1_temperature)
+
         if self.relay:
+            self.relay.power_meter.check_cooling(evaporator_temperature)
+
             if self.is_on:
                 compressor_temperature = self.compressor_temperature
-                logger.debug(
-                    f"💡 Allowed compressor ΔT: {round(Fridge.MAX_COMPRESSOR_TEMP_C - compressor_temperature, 2)}°C"
+                COMPRESSOR_ALLOWED_DELTA(
+                    Fridge.MAX_COMPRESSOR_TEMP_C - compressor_temperature
                 )
                 if compressor_temperature > Fridge.MAX_COMPRESSOR_TEMP_C:
                     self.in_cooldown = True
                     self.off(emergency=True)
                     logger.info("🔥 Cooldown")
             elif self.in_cooldown:
-                logger.debug(
-                    f"🕐 In cooldown since {timedelta(seconds=self.relay.seconds_since_last_state_change)}"
-                )
+                IN_COOLDOWN_SINCE(self.relay.seconds_since_last_state_change)
                 if (
                     self.relay.seconds_since_last_state_change
                     > Fridge.COOLDOWN_TIME_SECONDS
@@ -444,4 +683,4 @@ class Fridge:
                     logger.info("!Cooldown")
 
         if self.thermostat:
-            self.thermostat.run()
+            self.thermostat.run(evaporator_temperature, shelf1_temperature)
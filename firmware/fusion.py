@@ -0,0 +1,177 @@
+import logging
+import numpy as np
+import os
+import time
+
+
+# State vector
+EVAPORATOR = 0
+EVAPORATOR_RATE = 1
+AIR = 2
+# Heat leaking into the air (room through the walls, door openings, ...) and
+# into the beer, as a temperature rate in °C/s. Without them the model would
+# have the air settle on the evaporator and the beer on the air, and report a
+# constant drop at steady state.
+AIR_HEAT_LEAK = 3
+BEER = 4
+BEER_HEAT_LEAK = 5
+STATE_SIZE = 6
+
+# Measurement vector
+MEASUREMENTS = ["evaporator", "shelf1", "waterproof", "ir_beer"]
+MEASUREMENT_STATE = [EVAPORATOR, AIR, BEER, BEER]
+# Standard deviation of each sensor in °C. The MLX90640 is much noisier and
+# sees the can surface rather than what's inside.
+MEASUREMENT_STD = [0.1, 0.1, 0.1, 1.0]
+
+# Thermal time constants in seconds. The air follows the evaporator plate and
+# the beer follows the air.
+AIR_TIME_CONSTANT_SEC = 10 * 60
+BEER_TIME_CONSTANT_SEC = 60 * 60
+
+# Process noise spectral density, variance per second for each state. This is
+# what absorbs everything the model ignores (door openings, room heat, ...).
+PROCESS_NOISE = [1e-3, 1e-5, 1e-3, 1e-9, 1e-5, 1e-10]
+INITIAL_STD = [1.0, 0.01, 1.0, 0.01, 2.0, 0.001]
+
+MAX_UPDATE_GAP_SEC = 10 * 60
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+class TemperatureEstimator:
+    """Kalman filter fusing the inside sensors into beer and air temperature.
+
+    The model is a chain of first order lags: the evaporator follows a
+    constant rate, the air relaxes toward the evaporator and the beer relaxes
+    toward the air, each with a slowly varying heat leak term that is
+    estimated along. Rates of change fall out of the model, so the beer rate
+    reacts as soon as the air moves instead of waiting for the beer sensors.
+    Any measurement can be missing (None/NaN) on a given update.
+    """
+
+    def __init__(
+        self,
+        air_time_constant=AIR_TIME_CONSTANT_SEC,
+        beer_time_constant=BEER_TIME_CONSTANT_SEC,
+    ):
+        self.air_time_constant = air_time_constant
+        self.beer_time_constant = beer_time_constant
+
+        self.x = None
+        self.P = None
+        self.timestamp = None
+
+        self.H = np.zeros((len(MEASUREMENTS), STATE_SIZE))
+        self.H[np.arange(len(MEASUREMENTS)), MEASUREMENT_STATE] = 1
+        self.R = np.diag(np.square(MEASUREMENT_STD))
+        self.Q = np.diag(PROCESS_NOISE)
+
+        # Rates as linear combinations of the state, in °C/s
+        self.air_rate_row = np.zeros(STATE_SIZE)
+        self.air_rate_row[[EVAPORATOR, AIR]] = [1, -1]
+        self.air_rate_row /= air_time_constant
+        self.air_rate_row[AIR_HEAT_LEAK] = 1
+        self.beer_rate_row = np.zeros(STATE_SIZE)
+        self.beer_rate_row[[AIR, BEER]] = [1, -1]
+        self.beer_rate_row /= beer_time_constant
+        self.beer_rate_row[BEER_HEAT_LEAK] = 1
+
+    @property
+    def is_initialized(self):
+        return self.x is not None
+
+    def _transition(self, dt):
+        A = np.zeros((STATE_SIZE, STATE_SIZE))
+        A[EVAPORATOR, EVAPORATOR_RATE] = 1
+        A[AIR] = self.air_rate_row
+        A[BEER] = self.beer_rate_row
+
+        return np.eye(STATE_SIZE) + A * dt
+
+    def _initialize(self, z, mask):
+        self.x = np.zeros(STATE_SIZE)
+        for i in np.flatnonzero(mask):
+            self.x[MEASUREMENT_STATE[i]] = z[i]
+
+        if not mask[1]:
+            self.x[AIR] = self.x[EVAPORATOR]
+        if not mask[2] and not mask[3]:
+            self.x[BEER] = self.x[AIR]
+
+        # Start from equilibrium rather than assuming everything is cooling
+        self.x[AIR_HEAT_LEAK] = -(self.x[EVAPORATOR] - self.x[AIR]) / (
+            self.air_time_constant
+        )
+        self.x[BEER_HEAT_LEAK] = -(self.x[AIR] - self.x[BEER]) / (
+            self.beer_time_constant
+        )
+
+        self.P = np.diag(np.square(INITIAL_STD))
+
+    def update(self, evaporator, shelf1, waterproof=None, ir_beer=None, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        # Missing measurements (None) become NaN
+        z = np.array([evaporator, shelf1, waterproof, ir_beer], dtype=float)
+        mask = ~np.isnan(z)
+
+        if not self.is_initialized or (timestamp - self.timestamp) > MAX_UPDATE_GAP_SEC:
+            self._initialize(z, mask)
+            self.timestamp = timestamp
+            return
+
+        dt = timestamp - self.timestamp
+        self.timestamp = timestamp
+
+        # Predict
+        F = self._transition(dt)
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + self.Q * dt
+
+        if not mask.any():
+            return
+
+        # Correct with whatever we have
+        H = self.H[mask]
+        R = self.R[np.ix_(mask, mask)]
+        y = z[mask] - H @ self.x
+        S = H @ self.P @ H.T + R
+        K = np.linalg.solve(S, H @ self.P).T
+        self.x = self.x + K @ y
+        self.P = (np.eye(STATE_SIZE) - K @ H) @ self.P
+        self.P = (self.P + self.P.T) / 2
+
+    def _estimate(self, row):
+        if not self.is_initialized:
+            return None, None
+
+        return float(row @ self.x), float(np.sqrt(row @ self.P @ row))
+
+    def _state_row(self, index):
+        row = np.zeros(STATE_SIZE)
+        row[index] = 1
+        return row
+
+    @property
+    def beer_temperature(self):
+        """(estimate, standard deviation) in °C"""
+        return self._estimate(self._state_row(BEER))
+
+    @property
+    def air_temperature(self):
+        """(estimate, standard deviation) in °C"""
+        return self._estimate(self._state_row(AIR))
+
+    @property
+    def beer_rate(self):
+        """(estimate, standard deviation) in °C/h"""
+        return self._estimate(self.beer_rate_row * 3600)
+
+    @property
+    def air_rate(self):
+        """(estimate, standard deviation) in °C/h"""
+        return self._estimate(self.air_rate_row * 3600)
+
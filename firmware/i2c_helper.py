@@ -1,11 +1,13 @@
-import adafruit_ds18x20
 import adafruit_mlx90640
 import adafruit_tmp117
+import busio
+import hid
 import logging
 import os
 
 from ds2482.ds2482 import DS2482
 from ds2482.onewire import OneWireBus
+from onewire_probes import OneWireProbes
 
 
 MAX_NUMBER_OF_TMP117 = 4
@@ -16,7 +18,20 @@ if "DEBUG" in os.environ:
     logger.setLevel(logging.DEBUG)
 
 
-def enumerate(buses, compressor_tmp117_addr, condenser_tmp117_addr):
+def open_buses(vid, pid):
+    buses = []
+    addresses = [mcp["path"] for mcp in hid.enumerate(vid, pid)]
+    for address in addresses:
+        logger.debug(f"New I2C bus: {address}")
+        bus = busio.I2C(bus_id=address, frequency=400000)
+        buses.append(bus)
+
+    return buses
+
+
+def enumerate(
+    buses, compressor_tmp117_addr, condenser_tmp117_addr, onewire_config=None
+):
     i2c_bus_internal = None
 
     # Find which i2c bus has the camera
@@ -70,8 +85,9 @@ def enumerate(buses, compressor_tmp117_addr, condenser_tmp117_addr):
                 )
             )
 
-        ds18b20 = adafruit_ds18x20.DS18X20(ow_bus, devices[0])
+        onewire_probes = OneWireProbes(ow_bus, devices, onewire_config)
     except Exception:
-        ds18b20 = None
+        logger.exception("No DS18B20 probes")
+        onewire_probes = None
 
-    return mlx, compressor_tmp117, condenser_tmp117, inside_tmp117, ds18b20
+    return mlx, compressor_tmp117, condenser_tmp117, inside_tmp117, onewire_probes
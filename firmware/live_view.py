@@ -0,0 +1,303 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import struct
+import threading
+import time
+
+from http import HTTPStatus
+
+MAX_CLIENTS = 64
+REQUEST_TIMEOUT_SEC = 10
+# Per client transport buffer, a client that can't keep up skips frames
+# instead of having them queued here.
+WRITE_BUFFER_HIGH_WATER = 256 * 1024
+# Viewers only ever send ping/close, anything bigger gets the connection
+# closed instead of buffered.
+MAX_INCOMING_FRAME_SIZE = 4 * 1024
+WEBSOCKET_CLOSE_TOO_BIG = 1009
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+def _encode_raw(frame):
+    return np.asarray(frame, dtype="<f4").tobytes()
+
+
+def _encode_json(frame):
+    return json.dumps(np.round(frame, 2).tolist()).encode("utf-8")
+
+
+class FrameCache:
+    """Keeps the latest IR frame and its encoded representations.
+
+    Every representation is encoded at most once per frame version no matter
+    how many viewers ask for it. Representations that are already produced
+    elsewhere (the PNG published over MQTT) can be handed in directly.
+    """
+
+    ENCODERS = {
+        "raw": (_encode_raw, "application/octet-stream"),
+        "json": (_encode_json, "application/json"),
+        "png": (None, "image/png"),
+    }
+
+    def __init__(self):
+        self.version = 0
+        self.frame = None
+        self.timestamp = None
+
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def update(self, frame, **encoded):
+        with self._lock:
+            if frame is self.frame:
+                return False
+
+            self.version += 1
+            self.frame = frame
+            self.timestamp = time.time()
+            self._encoded = {k: bytes(v) for k, v in encoded.items()}
+
+        return True
+
+    def get(self, name):
+        with self._lock:
+            version, frame, encoded = self.version, self.frame, self._encoded
+
+            if frame is None:
+                return version, None
+
+            if name not in encoded:
+                encoder, _ = FrameCache.ENCODERS[name]
+                if encoder is None:
+                    return version, None
+                encoded[name] = encoder(frame)
+
+            return version, encoded[name]
+
+
+class LiveView:
+    """Embedded HTTP/WebSocket server running its own event loop in a
+    background thread.
+
+    Routes:
+        /frame.png, /frame.raw, /frame.json  Latest IR frame
+        /state.json                          Latest sensor values and relay
+        /ws                                  Push state (text) and raw frame
+                                             (binary) on every new frame
+    """
+
+    def __init__(self, host="0.0.0.0", port=8080):
+        self.host = host
+        self.port = port
+
+        self.frame_cache = FrameCache()
+        self.state = {}
+        self.clients = 0
+
+        self._loop = None
+        self._frame_event = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="live-view", daemon=True)
+        self._thread.start()
+
+    def update_frame(self, frame, **encoded):
+        if self.frame_cache.update(frame, **encoded):
+            self._notify()
+
+    def update_state(self, **values):
+        # Swap the whole dict so readers never see a half updated state
+        self.state = {**self.state, **values, "timestamp": time.time()}
+
+    def _notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake_clients)
+
+    def _wake_clients(self):
+        self._frame_event.set()
+        self._frame_event = asyncio.Event()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._frame_event = asyncio.Event()
+
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port)
+        )
+        logger.info(f"📺 Live view listening on {self.host}:{self.port}")
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+
+    async def _handle(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH_WATER)
+
+        if self.clients >= MAX_CLIENTS:
+            logger.debug("📺 Too many clients")
+            try:
+                await self._respond(writer, 503, b"Too many clients")
+            finally:
+                writer.close()
+            return
+
+        self.clients += 1
+        try:
+            method, path, headers = await asyncio.wait_for(
+                self._read_request(reader), REQUEST_TIMEOUT_SEC
+            )
+            logger.debug(f"📺 {method} {path}")
+
+            if method != "GET":
+                await self._respond(writer, 405, b"Method not allowed")
+            elif path == "/ws" and "sec-websocket-key" in headers:
+                await self._websocket(reader, writer, headers["sec-websocket-key"])
+            elif path == "/state.json":
+                await self._respond(
+                    writer,
+                    200,
+                    json.dumps(self.state).encode("utf-8"),
+                    "application/json",
+                )
+            elif path.startswith("/frame."):
+                await self._respond_frame(writer, path[len("/frame.") :])
+            else:
+                await self._respond(writer, 404, b"Not found")
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Live view client error")
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) < 2:
+            raise ConnectionError("Malformed request")
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        return request_line[0], request_line[1].split("?")[0], headers
+
+    async def _respond(self, writer, status, body, content_type="text/plain"):
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Cache-Control: no-cache\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await writer.drain()
+
+    async def _respond_frame(self, writer, name):
+        if name not in FrameCache.ENCODERS:
+            await self._respond(writer, 404, b"Not found")
+            return
+
+        _, body = self.frame_cache.get(name)
+        if body is None:
+            await self._respond(writer, 503, b"No frame yet")
+            return
+
+        await self._respond(writer, 200, body, FrameCache.ENCODERS[name][1])
+
+    async def _websocket(self, reader, writer, key):
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode("latin-1")).digest()
+        ).decode("latin-1")
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+
+        receiver = asyncio.ensure_future(self._websocket_receive(reader, writer))
+        sent_version = None
+        try:
+            while not receiver.done():
+                version, raw = self.frame_cache.get("raw")
+                if raw is not None and version != sent_version:
+                    self._websocket_send(writer, 0x1, json.dumps(self.state).encode())
+                    self._websocket_send(writer, 0x2, raw)
+                    # Backpressure: we only look at the latest frame once the
+                    # previous one has been flushed, so slow clients skip
+                    # frames instead of buffering them.
+                    await writer.drain()
+                    sent_version = version
+                    continue
+
+                frame_event = asyncio.ensure_future(self._frame_event.wait())
+                await asyncio.wait(
+                    (frame_event, receiver), return_when=asyncio.FIRST_COMPLETED
+                )
+                frame_event.cancel()
+        finally:
+            receiver.cancel()
+
+    async def _websocket_receive(self, reader, writer):
+        while True:
+            header = await reader.readexactly(2)
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+            elif length == 127:
+                (length,) = struct.unpack("!Q", await reader.readexactly(8))
+
+            if length > MAX_INCOMING_FRAME_SIZE:
+                logger.debug(f"📺 Incoming WebSocket frame too big ({length}B)")
+                self._websocket_send(
+                    writer, 0x8, struct.pack("!H", WEBSOCKET_CLOSE_TOO_BIG)
+                )
+                return
+
+            mask = await reader.readexactly(4) if header[1] & 0x80 else None
+            payload = await reader.readexactly(length)
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+            if opcode == 0x8:
+                self._websocket_send(writer, 0x8, payload[:2])
+                return
+            if opcode == 0x9:
+                self._websocket_send(writer, 0xA, payload)
+
+    @staticmethod
+    def _websocket_send(writer, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < (1 << 16):
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+        writer.write(header + payload)
@@ -1,9 +1,11 @@
+import acquisition
 import asyncio
 import board
 import busio
 import faulthandler
 import forensic
 import hid
+import json
 import logging
 import matplotlib.pyplot as plt
 import os
@@ -12,13 +14,17 @@ import signal
 import sys
 import time
 import traceback
+import tracing
 
 from pprint import pprint
 
 import i2c_helper
+import live_view
+import onewire_probes as onewire
 import persistent_state
+import profiler
 
-from fridge import Fridge, Thermostat, DefrostThermostat, S31Relay
+from fridge import Fridge, Thermostat, DefrostThermostat, BeerThermostat, S31Relay
 from hass_mqtt_discovery.ha_mqtt_device import Device, Sensor
 
 
@@ -27,6 +33,11 @@ LOOP_SLEEP_SEC = 10
 
 MAX_APP_RESTART_COUNT = 5
 
+# Loop iterations taking longer than this get profiled
+LOOP_BUDGET_SEC = WATCHDOG_TIMEOUT_SEC / 2
+
+LOOP_ITERATION = tracing.event("loop_iteration", "I", "─── Loop iteration {}")
+
 MCP2221_VID = 0x04D8
 MCP2221_PID = 0x00DD
 
@@ -69,6 +80,12 @@ def teardown():
     except Exception:
         logger.exception("Could not disconnect MQTT client")
 
+    if acquisition_process:
+        try:
+            acquisition_process.stop()
+        except Exception:
+            logger.exception("Could not stop acquisition process")
+
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)-8s %(message)s",
@@ -80,9 +97,15 @@ logger = logging.getLogger(__name__)
 if "DEBUG" in os.environ:
     logger.setLevel(logging.DEBUG)
 
+# Bound early, teardown() can run from SIGTERM at any point of startup
+acquisition_process = None
+
 signal.signal(signal.SIGTERM, sigterm_handler)
 signal.signal(signal.SIGUSR2, hang)
 
+tracing.install_error_hooks()
+forensic.register_trace_dump_hook(tracing.tracer)
+
 kick_watchdog()
 
 pstate = persistent_state.load()
@@ -99,16 +122,36 @@ if pstate["restart_count"] == MAX_APP_RESTART_COUNT:
     while True:
         time.sleep(1)
 
-i2c_buses = []
-addresses = [mcp["path"] for mcp in hid.enumerate(MCP2221_VID, MCP2221_PID)]
-for address in addresses:
-    logger.debug(f"New I2C bus: {address}")
-    i2c_bus = busio.I2C(bus_id=address, frequency=400000)
-    i2c_buses.append(i2c_bus)
-
-mlx, compressor_tmp117, condenser_tmp117, inside_tmp117, ds18b20 = i2c_helper.enumerate(
-    i2c_buses, COMPRESSOR_TMP117_ADDR, CONDENSER_TMP117_ADDR
-)
+if "ISOLATED_ACQUISITION" in os.environ:
+    acquisition_process = acquisition.Acquisition(
+        MCP2221_VID, MCP2221_PID, COMPRESSOR_TMP117_ADDR, CONDENSER_TMP117_ADDR
+    )
+    acquisition_process.start()
+    # Startup timeout is shorter than the watchdog so a child that never
+    # comes up gets reported instead of killed by faulthandler
+    kick_watchdog()
+    (
+        mlx,
+        compressor_tmp117,
+        condenser_tmp117,
+        inside_tmp117,
+        onewire_probes,
+    ) = acquisition_process.sensors()
+else:
+    i2c_buses = i2c_helper.open_buses(MCP2221_VID, MCP2221_PID)
+    (
+        mlx,
+        compressor_tmp117,
+        condenser_tmp117,
+        inside_tmp117,
+        onewire_probes,
+    ) = i2c_helper.enumerate(
+        i2c_buses,
+        COMPRESSOR_TMP117_ADDR,
+        CONDENSER_TMP117_ADDR,
+        onewire.load_config(),
+    )
+ds18b20 = onewire_probes.primary if onewire_probes else None
 
 client = mqtt.Client()
 last_log_time = 0
@@ -132,6 +175,16 @@ if ds18b20:
         unit_of_measurement="°C",
         topic_parent_level="inside",
     )
+probe_sensors = {}
+if onewire_probes:
+    for rom in onewire_probes.probes:
+        probe_sensors[rom] = Sensor(
+            client,
+            f"ds18b20_{rom}",
+            parent_device=fridge_device,
+            unit_of_measurement="°C",
+            topic_parent_level="inside",
+        )
 coldest_beer_sensor = Sensor(
     client,
     "coldest_beer",
@@ -146,11 +199,80 @@ ir_self1_sensor = Sensor(
     unit_of_measurement="°C",
     topic_parent_level="inside",
 )
+beer_estimate_sensor = Sensor(
+    client,
+    "beer_estimate",
+    parent_device=fridge_device,
+    unit_of_measurement="°C",
+    topic_parent_level="inside",
+)
+beer_uncertainty_sensor = Sensor(
+    client,
+    "beer_uncertainty",
+    parent_device=fridge_device,
+    unit_of_measurement="°C",
+    topic_parent_level="inside",
+)
+beer_rate_sensor = Sensor(
+    client,
+    "beer_rate",
+    parent_device=fridge_device,
+    unit_of_measurement="°C/h",
+    topic_parent_level="inside",
+)
+air_estimate_sensor = Sensor(
+    client,
+    "air_estimate",
+    parent_device=fridge_device,
+    unit_of_measurement="°C",
+    topic_parent_level="inside",
+)
+power_sensor = Sensor(
+    client,
+    "power",
+    parent_device=fridge_device,
+    unit_of_measurement="W",
+    topic_parent_level="outside",
+)
+energy_per_day_sensor = Sensor(
+    client,
+    "energy_per_day",
+    parent_device=fridge_device,
+    unit_of_measurement="kWh",
+    topic_parent_level="outside",
+)
+duty_cycle_sensor = Sensor(
+    client,
+    "duty_cycle",
+    parent_device=fridge_device,
+    unit_of_measurement="%",
+    topic_parent_level="outside",
+)
+mode_cycle_energy_sensor = Sensor(
+    client,
+    "mode_cycle_energy",
+    parent_device=fridge_device,
+    unit_of_measurement="Wh",
+    topic_parent_level="outside",
+)
+cycle_energy_sensor = Sensor(
+    client,
+    "cycle_energy",
+    parent_device=fridge_device,
+    unit_of_measurement="Wh",
+    topic_parent_level="outside",
+)
 
 plt.style.use("dark_background")
 
 forensic.register_debug_hook()
 
+sampling_profiler = profiler.SamplingProfiler()
+loop_monitor = profiler.LoopMonitor(sampling_profiler, LOOP_BUDGET_SEC)
+forensic.register_profile_hook(sampling_profiler)
+profiler.register_mqtt_command(sampling_profiler, client)
+tracing.register_mqtt_command(client)
+
 relay = S31Relay(client)
 # thermostat = Thermostat(relay, inside_tmp117[1], min_t=-4, max_t=4) # Min
 # thermostat = Thermostat(relay, inside_tmp117[1]) # Middle
@@ -161,15 +283,26 @@ thermostat = Thermostat(min_t=-12, max_t=-5)
 # thermostat = Thermostat(min_t=-14, max_t=-5)
 
 # thermostat = DefrostThermostat()
+# thermostat = BeerThermostat(min_t=-2, max_t=1)
 
 fridge = Fridge(
     mlx, inside_tmp117, compressor_tmp117, condenser_tmp117, ds18b20, relay, thermostat
 )
 
+viewer = None
+if "LIVE_VIEW_PORT" in os.environ:
+    viewer = live_view.LiveView(port=int(os.environ["LIVE_VIEW_PORT"]))
+    viewer.start()
+
 kick_watchdog()
 logger.info("We are online!")
 
+loop_iteration = 0
 while True:
+    loop_monitor.iteration_start()
+    LOOP_ITERATION(loop_iteration)
+    loop_iteration += 1
+
     logger.debug("Waiting for publish")
     try:
         mqtt_mi.wait_for_publish()
@@ -178,29 +311,92 @@ while True:
     except Exception:
         logger.exception("Error waiting for publish")
 
-    logger.debug("Frame publish")
-    mqtt_mi = client.publish("inside/thermal1", fridge.ir_image)
-
-    for i, temp in enumerate(fridge.discrete_temperature_readings):
-        client.publish(f"inside/tmp117/{i}", temp)
-
-    client.publish(f"outside/compressor/temperature", fridge.compressor_temperature)
-    client.publish(f"outside/side/temperature", fridge.condenser_temperature)
-
-    if ds18b20:
-        ds18b20_sensor.send(fridge.waterproof_temperature)
-
-    coldest_beer_sensor.send(fridge.coldest_beer_temperature)
-    ir_self1_sensor.send(fridge.ir_self1_temperature)
-
-    relay.keepalive()
-    fridge.run()
+    try:
+        if onewire_probes:
+            onewire_probes.tick()
+
+        logger.debug("Frame publish")
+        ir_frame = fridge.ir_frame
+        ir_image = fridge.ir_frame_to_image(ir_frame)
+        mqtt_mi = client.publish("inside/thermal1", ir_image)
+
+        discrete_temperature_readings = fridge.discrete_temperature_readings
+        for i, temp in enumerate(discrete_temperature_readings):
+            client.publish(f"inside/tmp117/{i}", temp)
+
+        compressor_temperature = fridge.compressor_temperature
+        condenser_temperature = fridge.condenser_temperature
+        client.publish(f"outside/compressor/temperature", compressor_temperature)
+        client.publish(f"outside/side/temperature", condenser_temperature)
+
+        if ds18b20:
+            ds18b20_sensor.send(fridge.waterproof_temperature)
+
+        for rom, probe_sensor in probe_sensors.items():
+            try:
+                probe_sensor.send(round(onewire_probes.probes[rom].temperature, 2))
+            except acquisition.AcquisitionUnavailable:
+                raise
+            except Exception:
+                logger.exception(f"Error reading DS18B20 {rom}")
+
+        coldest_beer_temperature = fridge.coldest_beer_temperature
+        ir_self1_temperature = fridge.ir_self1_temperature
+        coldest_beer_sensor.send(coldest_beer_temperature)
+        ir_self1_sensor.send(ir_self1_temperature)
+
+        if viewer:
+            viewer.update_frame(ir_frame, png=ir_image)
+            viewer.update_state(
+                tmp117=discrete_temperature_readings,
+                compressor=compressor_temperature,
+                condenser=condenser_temperature,
+                waterproof=fridge.waterproof_temperature if ds18b20 else None,
+                coldest_beer=float(coldest_beer_temperature),
+                ir_shelf1=float(ir_self1_temperature),
+                relay=relay.state,
+                power=relay.power_meter.power,
+            )
+
+        power_meter = relay.power_meter
+        power_usage = fridge.power_usage
+        if power_usage is not None:
+            power_sensor.send(power_usage)
+        # Not enough data yet right after a restart
+        if power_meter.kwh_per_day is not None:
+            energy_per_day_sensor.send(power_meter.kwh_per_day)
+            duty_cycle_sensor.send(round(power_meter.duty_cycle * 100, 1))
+        if power_meter.last_cycle:
+            cycle_energy_sensor.send(round(power_meter.last_cycle.energy_wh, 2))
+        mode_cycle_energy = power_meter.mode_average_cycle_energy(power_meter.mode)
+        if mode_cycle_energy is not None:
+            mode_cycle_energy_sensor.send(round(mode_cycle_energy, 2))
+        client.publish("outside/power/modes", json.dumps(power_meter.mode_summary()))
+        client.publish(
+            "outside/power/anomalies", ",".join(sorted(power_meter.anomalies))
+        )
+
+        relay.keepalive()
+        fridge.run()
+
+        if fridge.beer_temperature is not None:
+            beer_estimate_sensor.send(fridge.beer_temperature)
+            beer_uncertainty_sensor.send(fridge.beer_temperature_uncertainty)
+            beer_rate_sensor.send(fridge.beer_temperature_rate)
+            air_estimate_sensor.send(fridge.air_temperature)
+    except acquisition.AcquisitionUnavailable as e:
+        # Never act on old readings while the supervisor restarts the child,
+        # stop cooling as soon as the minimum ON time allows it.
+        logger.warning(f"⏸️ Skipping control step: {e}")
+        relay.keepalive()
+        fridge.off()
 
     if pstate["restart_count"] > 0:
         logger.debug("Resetting restart count to 0")
         pstate["restart_count"] = 0
         persistent_state.reset_restart_count()
 
+    loop_monitor.iteration_end()
     kick_watchdog()
 
     logger.debug("💤 Going to sleep")
@@ -0,0 +1,201 @@
+import adafruit_ds18x20
+import logging
+import math
+import os
+import time
+import yaml
+
+
+SKIP_ROM = 0xCC
+CONVERT_T = 0x44
+
+# Maximum conversion time per resolution from the DS18B20 datasheet
+CONVERSION_TIME_SEC = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+DEFAULT_RESOLUTION = 12
+# Scratchpad value after power-on, the probe never converted
+POWER_ON_RESET_C = 85.0
+# Probes refuse to serve readings older than this
+STALE_READING_SEC = 5 * 60
+
+CONFIG_FILE_PATH = "onewire.yaml"
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+class DS18B20Probe:
+    """Latest reading of one probe. Quacks like `adafruit_ds18x20.DS18X20`
+    for `Fridge` but never touches the bus."""
+
+    def __init__(self, device, rom):
+        self.device = device
+        self.rom = rom
+        self.conversion_time = None
+
+        self.reading = None
+        self.reading_timestamp = None
+
+    @property
+    def resolution(self):
+        return self.device.resolution
+
+    @resolution.setter
+    def resolution(self, bits):
+        self.device.resolution = bits
+        self.conversion_time = CONVERSION_TIME_SEC[bits]
+
+    @property
+    def temperature(self):
+        if self.reading is None:
+            raise RuntimeError(f"No reading from DS18B20 {self.rom} yet")
+
+        age = time.monotonic() - self.reading_timestamp
+        if age > STALE_READING_SEC:
+            raise RuntimeError(f"DS18B20 {self.rom} reading is {round(age)}s old")
+
+        return self.reading
+
+    def _collect(self):
+        temperature = self.device.read_temperature()
+        if temperature == POWER_ON_RESET_C:
+            raise RuntimeError(f"DS18B20 {self.rom} did not convert")
+
+        self.reading = temperature
+        self.reading_timestamp = time.monotonic()
+
+
+class OneWireProbes:
+    """Every DS18B20 on a 1-Wire bus, converted together.
+
+    A single Skip ROM + Convert T starts a conversion on all probes at once.
+    `tick()` collects the results of the previous conversion if it had time
+    to complete and starts the next one, so it never waits on a conversion
+    no matter how many probes are on the bus.
+    """
+
+    def __init__(self, ow_bus, devices, config=None):
+        if not devices:
+            raise ValueError("No DS18B20 on the bus")
+
+        self.ow_bus = ow_bus
+        self.probes = {}
+        self.conversion_start_timestamp = None
+
+        config = config or {}
+        resolution = config.get("resolution", DEFAULT_RESOLUTION)
+        # ROMs should be quoted in the YAML, don't choke if one isn't
+        probes_config = {
+            str(rom).lower(): probe_config or {}
+            for rom, probe_config in (config.get("probes") or {}).items()
+        }
+        for device in devices:
+            rom = bytes(device.rom).hex()
+            probe = DS18B20Probe(adafruit_ds18x20.DS18X20(ow_bus, device), rom)
+            probe_config = probes_config.get(rom, {})
+            probe.resolution = probe_config.get("resolution", resolution)
+            conversion_time = probe_config.get(
+                "conversion_time", config.get("conversion_time")
+            )
+            if conversion_time is not None:
+                probe.conversion_time = conversion_time
+            self.probes[rom] = probe
+            logger.info(
+                f"DS18B20 {rom} at {probe.resolution} bits ({probe.conversion_time}s)"
+            )
+
+        for rom in probes_config:
+            if rom not in self.probes:
+                logger.warning(f"DS18B20 {rom} is configured but not on the bus")
+
+        # Block once at startup so every probe has a reading right away. If
+        # the bus hiccups tick() logs it and the next tick() retries.
+        self.tick()
+        time.sleep(self.conversion_time)
+        self.tick()
+
+    @property
+    def primary(self):
+        """First probe found, the historical "waterproof" sensor."""
+        return next(iter(self.probes.values()))
+
+    @property
+    def conversion_time(self):
+        return max(probe.conversion_time for probe in self.probes.values())
+
+    def set_resolution(self, rom, bits):
+        self.probes[rom].resolution = bits
+
+    def set_conversion_time(self, rom, seconds):
+        """Override the datasheet conversion time, e.g. for slow clones."""
+        self.probes[rom].conversion_time = seconds
+
+    def _start_conversion(self):
+        self.ow_bus.reset()
+        self.ow_bus.write(bytes([SKIP_ROM, CONVERT_T]))
+        self.conversion_start_timestamp = time.monotonic()
+
+    def tick(self):
+        if self.conversion_start_timestamp is not None:
+            elapsed = time.monotonic() - self.conversion_start_timestamp
+            if elapsed < self.conversion_time:
+                logger.debug("⏳ DS18B20 conversion still running")
+                return
+
+            for probe in self.probes.values():
+                try:
+                    probe._collect()
+                except Exception:
+                    logger.exception(f"Error reading DS18B20 {probe.rom}")
+
+        try:
+            self._start_conversion()
+        except Exception:
+            self.conversion_start_timestamp = None
+            logger.exception("Could not start DS18B20 conversion")
+
+
+def _check_probe_config(config, name):
+    if not isinstance(config, dict):
+        raise ValueError(f"{name} must be a mapping, got {config!r}")
+
+    resolution = config.get("resolution", DEFAULT_RESOLUTION)
+    if type(resolution) is not int or resolution not in CONVERSION_TIME_SEC:
+        raise ValueError(
+            f"{name} resolution must be one of {list(CONVERSION_TIME_SEC)},"
+            f" got {resolution!r}"
+        )
+
+    conversion_time = config.get("conversion_time")
+    if conversion_time is not None and (
+        type(conversion_time) not in (int, float)
+        or not math.isfinite(conversion_time)
+        or conversion_time <= 0
+    ):
+        raise ValueError(
+            f"{name} conversion_time must be a positive number of seconds,"
+            f" got {conversion_time!r}"
+        )
+
+
+def load_config(path=CONFIG_FILE_PATH):
+    """Raises ValueError on an invalid config rather than running without
+    the probes."""
+    try:
+        with open(path) as f:
+            config = yaml.safe_load(f)
+    except FileNotFoundError:
+        return {}
+
+    logger.debug(config)
+    config = config or {}
+
+    _check_probe_config(config, path)
+    probes_config = config.get("probes") or {}
+    if not isinstance(probes_config, dict):
+        raise ValueError(f"{path} probes must be a mapping of ROM to settings")
+    for rom, probe_config in probes_config.items():
+        _check_probe_config(probe_config or {}, f"{path} probe {rom}")
+
+    return config
@@ -0,0 +1,241 @@
+import logging
+import math
+import os
+import threading
+import time
+
+
+# Time constant of the exponential averages used for kWh/day and duty cycle
+AVERAGE_TIME_CONSTANT_SEC = 24 * 60 * 60
+# kWh/day and duty cycle aren't reported before this much data was averaged
+MIN_AVERAGE_WINDOW_SEC = 60 * 60
+# Samples are 5s apart, anything longer is a gap we shouldn't integrate over
+MAX_SAMPLE_GAP_SEC = 60
+# Window after a relay state change where samples don't reflect the new state
+# yet: inrush current after ON, and the CSE7766 5s averaging after both.
+STARTUP_WINDOW_SEC = 10
+# Power drawn by the fridge with the compressor stopped (light, S31 itself)
+IDLE_POWER_W = 5
+# How long the compressor must run before we expect the evaporator to cool
+STALL_DETECT_SEC = 10 * 60
+MIN_COOLING_DELTA_C = 2
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+class CompressorCycle:
+    def __init__(self, start_timestamp, mode=None):
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = None
+        self.mode = mode
+        self.energy_wh = 0
+        self.peak_power = 0
+        self.startup_peak_current = 0
+        self.start_evaporator_temperature = None
+
+    @property
+    def duration(self):
+        end = self.end_timestamp if self.end_timestamp else time.time()
+        return end - self.start_timestamp
+
+    def __repr__(self):
+        return (
+            f"CompressorCycle(mode={self.mode}, duration={round(self.duration)}s, "
+            f"energy={round(self.energy_wh, 2)}Wh, peak={self.peak_power}W, "
+            f"startup_peak={self.startup_peak_current}A)"
+        )
+
+
+class PowerMeter:
+    """Streaming aggregator for the S31 CSE7766 samples.
+
+    Every statistic is updated incrementally so memory stays constant no
+    matter how long the firmware runs. Samples come from the MQTT thread,
+    properties are read from the control loop.
+    """
+
+    def __init__(self, time_constant=AVERAGE_TIME_CONSTANT_SEC):
+        self.time_constant = time_constant
+        self.mode = None
+
+        self.power = None
+        self.current = None
+        self.voltage = None
+
+        self.energy_wh = 0
+        # Exponential averages start from zero and are divided by the weight
+        # accumulated so far, so they are unbiased right after a restart.
+        self.average_weight = 0
+        self.averaged_sec = 0
+        self._power_average = 0
+        self._duty_cycle_average = 0
+
+        self.compressor_on = False
+        self.state_change_timestamp = None
+        self.cycle = None
+        self.last_cycle = None
+        # mode -> [cycle count, total energy Wh, total duration s]
+        self.mode_stats = {}
+
+        self.anomalies = set()
+
+        self.last_sample_timestamp = None
+
+        self._lock = threading.Lock()
+
+    @property
+    def average_power(self):
+        if self.averaged_sec < MIN_AVERAGE_WINDOW_SEC:
+            return None
+
+        return self._power_average / self.average_weight
+
+    @property
+    def kwh_per_day(self):
+        average_power = self.average_power
+        if average_power is None:
+            return None
+
+        return round(average_power * 24 / 1000, 3)
+
+    @property
+    def duty_cycle(self):
+        if self.averaged_sec < MIN_AVERAGE_WINDOW_SEC:
+            return None
+
+        return self._duty_cycle_average / self.average_weight
+
+    def add_power_sample(self, power, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+
+        with self._lock:
+            if self.last_sample_timestamp is not None:
+                dt = timestamp - self.last_sample_timestamp
+                if 0 < dt <= MAX_SAMPLE_GAP_SEC:
+                    # Trapezoidal integration
+                    interval_power = (self.power + power) / 2
+                    energy_wh = interval_power * dt / 3600
+                    self.energy_wh += energy_wh
+                    if self.cycle:
+                        self.cycle.energy_wh += energy_wh
+
+                    alpha = 1 - math.exp(-dt / self.time_constant)
+                    self._power_average += alpha * (
+                        interval_power - self._power_average
+                    )
+                    self._duty_cycle_average += alpha * (
+                        (1 if self.compressor_on else 0) - self._duty_cycle_average
+                    )
+                    self.average_weight += alpha * (1 - self.average_weight)
+                    self.averaged_sec += dt
+
+            self.power = power
+            self.last_sample_timestamp = timestamp
+
+            if self.cycle:
+                self.cycle.peak_power = max(self.cycle.peak_power, power)
+
+        self._check_power_anomalies(timestamp)
+
+    def add_current_sample(self, current, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+
+        self.current = current
+        cycle = self.cycle
+        if cycle and (timestamp - cycle.start_timestamp) <= STARTUP_WINDOW_SEC:
+            cycle.startup_peak_current = max(cycle.startup_peak_current, current)
+
+    def add_voltage_sample(self, voltage):
+        self.voltage = voltage
+
+    def compressor_state_changed(self, is_on, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+
+        with self._lock:
+            if is_on == self.compressor_on:
+                return
+
+            self.compressor_on = is_on
+            self.state_change_timestamp = timestamp
+
+            if is_on:
+                self.cycle = CompressorCycle(timestamp, self.mode)
+                return
+
+            if not self.cycle:
+                return
+
+            self.cycle.end_timestamp = timestamp
+            self.last_cycle = self.cycle
+            self.cycle = None
+
+            stats = self.mode_stats.setdefault(self.last_cycle.mode, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += self.last_cycle.energy_wh
+            stats[2] += self.last_cycle.duration
+
+        logger.info(f"🔌 {self.last_cycle}")
+
+    def mode_average_cycle_energy(self, mode):
+        if mode not in self.mode_stats:
+            return None
+
+        count, energy_wh, _ = self.mode_stats[mode]
+        return energy_wh / count
+
+    def mode_summary(self):
+        """Average cycle per thermostat mode, to compare modes."""
+        with self._lock:
+            return {
+                str(mode): {
+                    "cycles": count,
+                    "energy_wh": round(energy_wh / count, 2),
+                    "duration_sec": round(duration / count),
+                }
+                for mode, (count, energy_wh, duration) in self.mode_stats.items()
+            }
+
+    def check_cooling(self, evaporator_temperature):
+        cycle = self.cycle
+        if not cycle:
+            self._set_anomaly("stalled_compressor", False)
+            return
+
+        if cycle.start_evaporator_temperature is None:
+            cycle.start_evaporator_temperature = evaporator_temperature
+            return
+
+        drawing_power = self.power is not None and self.power > IDLE_POWER_W
+        not_cooling = (
+            cycle.start_evaporator_temperature - evaporator_temperature
+        ) < MIN_COOLING_DELTA_C
+
+        self._set_anomaly(
+            "stalled_compressor",
+            drawing_power and not_cooling and cycle.duration > STALL_DETECT_SEC,
+        )
+
+    def _check_power_anomalies(self, timestamp):
+        if (
+            self.state_change_timestamp is not None
+            and (timestamp - self.state_change_timestamp) <= STARTUP_WINDOW_SEC
+        ):
+            return
+
+        self._set_anomaly(
+            "no_power_while_on", self.compressor_on and self.power <= IDLE_POWER_W
+        )
+        self._set_anomaly(
+            "power_while_off", not self.compressor_on and self.power > IDLE_POWER_W
+        )
+
+    def _set_anomaly(self, name, active):
+        if active and name not in self.anomalies:
+            self.anomalies.add(name)
+            logger.error(f"⚠️ Power anomaly: {name}")
+        elif not active and name in self.anomalies:
+            self.anomalies.discard(name)
+            logger.info(f"✔️ Power anomaly cleared: {name}")
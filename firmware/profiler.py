@@ -0,0 +1,190 @@
+import forensic
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+
+
+PROFILE_DIR_PATH = "/persistent_state/profiles"
+MAX_PROFILE_FILES = 20
+
+SAMPLE_INTERVAL_SEC = 0.01
+FLUSH_INTERVAL_SEC = 5
+DEFAULT_DURATION_SEC = 30
+MAX_DURATION_SEC = 10 * 60
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread at a fixed rate from a background
+    thread and writes them in the collapsed format used by flamegraph.pl,
+    speedscope and friends.
+
+    The output is flushed periodically so that a profile started during a
+    stall survives the watchdog killing the process.
+    """
+
+    def __init__(
+        self,
+        output_dir=PROFILE_DIR_PATH,
+        interval=SAMPLE_INTERVAL_SEC,
+        max_files=MAX_PROFILE_FILES,
+    ):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.max_files = max_files
+
+        self.reason = None
+        self.stacks = Counter()
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, reason, duration=DEFAULT_DURATION_SEC):
+        with self._lock:
+            if self.is_running:
+                logger.debug(f"🔬 Profiler already running ({self.reason})")
+                return False
+
+            logger.info(f"🔬 Profiler started ({reason}, {duration}s)")
+            self.reason = reason
+            self.stacks = Counter()
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(reason, duration), name="profiler", daemon=True
+            )
+            self._thread.start()
+
+        return True
+
+    def stop(self):
+        # Only signal the sampler thread, it writes the result itself. This
+        # keeps stop() safe to call from a signal handler or MQTT callback.
+        self._stop_event.set()
+
+    def _run(self, reason, duration):
+        own_thread_id = threading.get_ident()
+        path = forensic.timestamped_path(self.output_dir, reason, ".folded")
+        deadline = time.monotonic() + duration
+        next_flush = time.monotonic() + FLUSH_INTERVAL_SEC
+
+        while not self._stop_event.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                stack = self._collapse(thread_names.get(thread_id, thread_id), frame)
+                self.stacks[stack] += 1
+
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= next_flush:
+                self._write(path)
+                next_flush = now + FLUSH_INTERVAL_SEC
+
+        self._write(path)
+        logger.info(
+            f"🔬 Profiler stopped ({reason}, {sum(self.stacks.values())} samples): {path}"
+        )
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+            )
+            frame = frame.f_back
+
+        stack.append(str(thread_name))
+        return ";".join(reversed(stack))
+
+    def _write(self, path):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(path, "w") as f:
+                for stack, count in self.stacks.items():
+                    f.write(f"{stack} {count}\n")
+            forensic.prune(self.output_dir, ".folded", self.max_files)
+        except Exception:
+            logger.exception("Could not write profile")
+
+
+class LoopMonitor:
+    """Starts the profiler when a loop iteration runs longer than `budget_sec`
+    and stops it when that iteration finally completes."""
+
+    def __init__(self, profiler, budget_sec):
+        self.profiler = profiler
+        self.budget_sec = budget_sec
+
+        self.iteration_start_timestamp = None
+        self.triggered = False
+
+        self._timer = None
+
+    def _overrun(self):
+        logger.error(f"⏰ Loop iteration exceeded {self.budget_sec}s budget")
+        self.triggered = self.profiler.start("overrun")
+
+    def iteration_start(self):
+        self.iteration_start_timestamp = time.monotonic()
+        self.triggered = False
+        self._timer = threading.Timer(self.budget_sec, self._overrun)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def iteration_end(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        if self.triggered:
+            logger.info(
+                f"⏰ Overrun iteration took {round(time.monotonic() - self.iteration_start_timestamp, 2)}s"
+            )
+            self.profiler.stop()
+            self.triggered = False
+
+
+def register_mqtt_command(profiler, mqtt_client, topic="fridge/profiler/command"):
+    """Payload is either "stop" or a profile duration in seconds, up to
+    MAX_DURATION_SEC (empty for the default)."""
+
+    def _command_callback(client, userdata, message):
+        payload = message.payload.decode("utf-8").strip()
+        logger.debug(f"📝 Received profiler command '{payload}'")
+
+        if payload == "stop":
+            profiler.stop()
+            return
+
+        try:
+            duration = float(payload) if payload else DEFAULT_DURATION_SEC
+        except ValueError:
+            duration = None
+
+        # Also rejects nan and inf
+        if duration is None or not 0 < duration <= MAX_DURATION_SEC:
+            logger.error(f"❌ Invalid profiler command '{payload}'")
+            return
+
+        profiler.start("mqtt", duration)
+
+    mqtt_client.message_callback_add(topic, _command_callback)
+    mqtt_client.subscribe(topic)
@@ -0,0 +1,236 @@
+import forensic
+import itertools
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+
+TRACE_DIR_PATH = "/persistent_state/traces"
+MAX_TRACE_FILES = 20
+
+RECORD_SIZE = 48
+DEFAULT_CAPACITY = 16384
+# Don't write more than one dump per interval when errors pile up
+MIN_DUMP_INTERVAL_SEC = 60
+
+HEADER = struct.Struct("<dH")
+
+
+logger = logging.getLogger(__name__)
+if "DEBUG" in os.environ:
+    logger.setLevel(logging.DEBUG)
+
+
+class Event:
+    """A typed trace event.
+
+    Calling it packs the timestamp and the raw arguments into the tracer's
+    ring, nothing gets formatted until the ring is dumped. Callers can check
+    `enabled` to skip computing expensive arguments.
+    """
+
+    def __init__(self, tracer, event_id, name, fields, message, level):
+        self.tracer = tracer
+        self.id = event_id
+        self.name = name
+        self.message = message
+        self.level = level
+        self.struct = struct.Struct(HEADER.format + fields)
+
+        if self.struct.size > RECORD_SIZE:
+            raise ValueError(f"Event {name} doesn't fit in a {RECORD_SIZE}B record")
+
+    @property
+    def enabled(self):
+        return self.level >= self.tracer.level
+
+    def __call__(self, *args):
+        if self.level < self.tracer.level:
+            return
+
+        self.tracer._record(self, args)
+
+    def format(self, values):
+        # "s" fields come back NUL padded
+        values = [
+            v.rstrip(b"\0").decode("utf-8", "replace") if isinstance(v, bytes) else v
+            for v in values
+        ]
+        return self.message.format(*values)
+
+
+class Tracer:
+    """Preallocated in-memory ring of fixed size binary trace records."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, level=logging.DEBUG):
+        self.capacity = capacity
+        self.level = level
+        self.echo = False
+
+        self.buffer = bytearray(capacity * RECORD_SIZE)
+        self.written = 0
+        # Event id 0 marks a never written slot
+        self.events = [None]
+
+        self.output_dir = TRACE_DIR_PATH
+        self.last_dump_timestamp = 0
+
+        self._counter = itertools.count()
+        self._dump_lock = threading.Lock()
+
+    def event(self, name, fields, message, level=logging.DEBUG):
+        event = Event(self, len(self.events), name, fields, message, level)
+        self.events.append(event)
+
+        return event
+
+    def _record(self, event, args):
+        # next() on itertools.count is atomic under the GIL, so the MQTT
+        # thread and the control loop never get the same slot.
+        index = next(self._counter)
+        event.struct.pack_into(
+            self.buffer,
+            (index % self.capacity) * RECORD_SIZE,
+            time.time(),
+            event.id,
+            *args,
+        )
+        self.written = index + 1
+
+        if self.echo:
+            logger.debug(event.format(args))
+
+    def records(self):
+        """Yields (timestamp, event, values) from oldest to newest."""
+        written = self.written
+        first = max(0, written - self.capacity)
+
+        for index in range(first, written):
+            offset = (index % self.capacity) * RECORD_SIZE
+            timestamp, event_id = HEADER.unpack_from(self.buffer, offset)
+            if not 0 < event_id < len(self.events):
+                continue
+
+            event = self.events[event_id]
+            values = event.struct.unpack_from(self.buffer, offset)[2:]
+            yield timestamp, event, values
+
+    def format(self):
+        lines = []
+        for timestamp, event, values in self.records():
+            try:
+                message = event.format(values)
+            except Exception:
+                message = f"{event.name} {values}"
+
+            lines.append(
+                "[{}.{:03d}] {:<8} {}".format(
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)),
+                    int((timestamp % 1) * 1000),
+                    logging.getLevelName(event.level),
+                    message,
+                )
+            )
+
+        return lines
+
+    def dump(self, reason, force=False):
+        # Never block on the lock: a dump can be requested from a signal
+        # handler or an error logged by the thread that is already dumping.
+        # Whoever holds the lock is writing the same ring anyway.
+        if not self._dump_lock.acquire(blocking=False):
+            return None
+
+        error = None
+        try:
+            now = time.monotonic()
+            if not force and (now - self.last_dump_timestamp) < MIN_DUMP_INTERVAL_SEC:
+                return None
+            self.last_dump_timestamp = now
+
+            path = forensic.timestamped_path(self.output_dir, reason, ".log")
+            try:
+                lines = self.format()
+                os.makedirs(self.output_dir, exist_ok=True)
+                with open(path, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+                forensic.prune(self.output_dir, ".log", MAX_TRACE_FILES)
+            except Exception as e:
+                error = e
+        finally:
+            self._dump_lock.release()
+
+        # Logged only once the lock is released
+        if error:
+            logger.error(f"Could not dump trace: {error!r}")
+            return None
+
+        logger.info(f"🧾 Trace dumped ({reason}, {len(lines)} events): {path}")
+        return path
+
+
+class _DumpOnErrorHandler(logging.Handler):
+    def __init__(self, tracer):
+        super().__init__(level=logging.ERROR)
+        self.tracer = tracer
+        self._local = threading.local()
+
+    def emit(self, record):
+        # Errors logged while dumping must not trigger another dump
+        if getattr(self._local, "dumping", False):
+            return
+
+        self._local.dumping = True
+        try:
+            self.tracer.dump("error")
+        finally:
+            self._local.dumping = False
+
+
+def _parse_level(name):
+    if name.isdigit():
+        return int(name)
+
+    # getLevelName() maps unknown names to the string "Level <name>"
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        logger.error(f"❌ Unknown TRACE_LEVEL '{name}', using DEBUG")
+        return logging.DEBUG
+
+    return level
+
+
+tracer = Tracer()
+if "TRACE_LEVEL" in os.environ:
+    tracer.level = _parse_level(os.environ["TRACE_LEVEL"])
+# Format events to the log as they happen, for development
+tracer.echo = "TRACE_ECHO" in os.environ
+
+
+def event(name, fields, message, level=logging.DEBUG):
+    return tracer.event(name, fields, message, level)
+
+
+def install_error_hooks():
+    """Dump the ring whenever something is logged at ERROR or above and when
+    the application dies on an uncaught exception."""
+    logging.getLogger().addHandler(_DumpOnErrorHandler(tracer))
+
+    previous_excepthook = sys.excepthook
+
+    def excepthook(*args):
+        tracer.dump("crash", force=True)
+        previous_excepthook(*args)
+
+    sys.excepthook = excepthook
+
+
+def register_mqtt_command(mqtt_client, topic="fridge/trace/dump"):
+    def _command_callback(client, userdata, message):
+        tracer.dump("mqtt", force=True)
+
+    mqtt_client.message_callback_add(topic, _command_callback)
+    mqtt_client.subscribe(topic)